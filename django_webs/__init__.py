@@ -14,13 +14,29 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from django.core.urlresolvers import reverse
+from django.core.urlresolvers import reverse, NoReverseMatch
 from django.db import models as m
 from django.core.paginator import Paginator, InvalidPage, EmptyPage
 from django.template import RequestContext, loader
 from django.shortcuts import render_to_response
 from django.http import HttpResponseRedirect, HttpResponseForbidden
 from django.utils.translation import ugettext as _
+from django.db import connection
+from django.db.models import Q
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.http import urlquote
+from django.conf import settings
+from django.core import signals
+
+from django_webs.metrics import record_metrics
+
+import Queue
+import datetime
+import logging
+import os
+import threading
+
+logger = logging.getLogger(__name__)
 
 class breadcrumb(object):
     def __init__(self, url, name):
@@ -33,6 +49,105 @@ def get_web_from_object(self):
     type_name = type(self).__name__
     return types[type_name]()
 
+##################
+# DELETE WORKERS #
+##################
+
+# seconds an idle delete worker waits before looking for stale deletes
+DELETE_SWEEP_INTERVAL = 60
+
+# deletes started by the current request
+_queued_deletes = threading.local()
+
+_delete_pool = None
+_delete_pool_lock = threading.Lock()
+
+# run a delete claimed with mark_delete_pending
+def run_delete(web_id, pk):
+    web = types[web_id]()
+    try:
+        instance = web.model._default_manager.get(pk=pk)
+    except web.model.DoesNotExist:
+        return
+    # not claimed, or the claim was rolled back
+    if not web.is_delete_pending(instance):
+        return
+    web.run_delete(instance)
+
+# resume deletes whose worker has died
+def sweep_deletes():
+    for web_type in types.values():
+        if not web_type.async_delete:
+            continue
+        web = web_type()
+        for instance in web.get_stale_deletes():
+            if web.mark_delete_pending(instance):
+                web.run_delete(instance)
+
+def delete_worker(queue):
+    while True:
+        try:
+            item = queue.get(timeout=DELETE_SWEEP_INTERVAL)
+        except Queue.Empty:
+            item = None
+
+        try:
+            try:
+                if item is None:
+                    sweep_deletes()
+                else:
+                    run_delete(*item)
+            except Exception:
+                logger.exception("Background delete failed")
+        finally:
+            # this thread owns its own connection, don't leave it open
+            connection.close()
+
+# get the queue of this process's delete workers, starting them if needed
+def get_delete_queue():
+    global _delete_pool
+    _delete_pool_lock.acquire()
+    try:
+        pid = os.getpid()
+        # threads don't survive fork(), each worker needs its own pool
+        if _delete_pool is None or _delete_pool[0] != pid:
+            queue = Queue.Queue()
+            for i in range(getattr(settings, 'WEBS_DELETE_WORKERS', 2)):
+                thread = threading.Thread(target=delete_worker, args=(queue,))
+                thread.daemon = True
+                thread.start()
+            _delete_pool = (pid, queue)
+        return _delete_pool[1]
+    finally:
+        _delete_pool_lock.release()
+
+# the claim can't be seen by the workers until the request's transaction
+# commits, so the delete is held until the request has finished
+def queue_delete(web, pk):
+    if not hasattr(_queued_deletes, "items"):
+        _queued_deletes.items = []
+    _queued_deletes.items.append((web.web_id, pk))
+
+def start_queued_deletes(**kwargs):
+    items = getattr(_queued_deletes, "items", [])
+    _queued_deletes.items = []
+
+    # with no workers, delete before the response is finished
+    if getattr(settings, 'WEBS_DELETE_WORKERS', 2) == 0:
+        for web_id, pk in items:
+            run_delete(web_id, pk)
+        return
+
+    # start the pool even with nothing to do, so it sweeps stale deletes
+    for web_type in types.values():
+        if web_type.async_delete:
+            queue = get_delete_queue()
+            for item in items:
+                queue.put(item)
+            break
+
+signals.request_finished.connect(start_queued_deletes)
+
 class web_metaclass(type):
     def __new__(cls, name, bases, attrs):
         result = type.__new__(cls, name, bases, attrs)
@@ -48,6 +163,18 @@ class web(object):
     __metaclass__ = web_metaclass
     app_label = None
 
+    # if True, delete objects in a pool of WEBS_DELETE_WORKERS background
+    # threads (default 2, 0 deletes at the end of the request). The model
+    # needs a nullable DateTimeField, named by delete_pending_field, that
+    # records when the worker last made progress. Objects with it set are
+    # locked, and hidden from lists built from a queryset. A delete that
+    # makes no progress for delete_stale_timeout seconds is assumed dead,
+    # and is resumed by the next idle worker.
+    async_delete = False
+    delete_pending_field = None
+    delete_batch_size = 1000
+    delete_stale_timeout = 300
+
     def assert_instance_type(self, instance):
         type_name = type(instance).__name__
         expected_type = self.web_id
@@ -68,6 +195,8 @@ class web(object):
     def perm_id(self):
         return self.web_id
 
+    # URLs are named <url_prefix>_list, _detail, _add, _edit and _delete,
+    # plus _delete_progress if async_delete is set
     @property
     def url_prefix(self):
         return self.web_id
@@ -90,6 +219,20 @@ class web(object):
     def get_instance(self):
         return self.model()
 
+    # restrict queryset to the objects this user may see, override for
+    # row level permissions
+    def filter_queryset_for_user(self, user, queryset):
+        return queryset
+
+    def has_instance_perms(self, user, instance):
+        self.assert_instance_type(instance)
+        queryset = self.model._default_manager.filter(pk=instance.pk)
+        filtered = self.filter_queryset_for_user(user, queryset)
+        # not filtered, don't need to ask the database
+        if filtered is queryset:
+            return True
+        return filtered.exists()
+
     def pre_save(self, instance, form):
         self.assert_instance_type(instance)
         return True
@@ -110,6 +253,11 @@ class web(object):
         breadcrumbs.append(breadcrumb(reverse(self.url_prefix+"_list"), self.verbose_name_plural))
         return breadcrumbs
 
+    # get the objects this user may see in the list
+    def get_list_queryset(self, user, queryset):
+        queryset = self.exclude_delete_pending(queryset)
+        return self.filter_queryset_for_user(user, queryset)
+
     def get_list_buttons(self, user):
         buttons = []
 
@@ -223,6 +371,134 @@ class web(object):
         self.assert_instance_type(instance)
         return(self.url_prefix+"_list",)
 
+    # get the URL to show progress of a background delete
+    @m.permalink
+    def get_delete_progress_url(self, instance):
+        self.assert_instance_type(instance)
+        return(self.url_prefix+'_delete_progress', [ str(instance.pk) ])
+
+    # get querysets of children to delete, in batches, before the object
+    # is deleted. Override for objects with large cascades.
+    def get_delete_cascade(self, instance):
+        self.assert_instance_type(instance)
+        return []
+
+    def get_delete_pending_field(self):
+        if self.delete_pending_field is None:
+            raise ImproperlyConfigured("%s sets async_delete but not delete_pending_field"%(self.web_id))
+        return self.delete_pending_field
+
+    # fail early, rather than with NoReverseMatch on every pending redirect
+    def check_async_delete(self):
+        self.get_delete_pending_field()
+        try:
+            reverse(self.url_prefix+"_delete_progress", args=[ "0" ])
+        except NoReverseMatch:
+            raise ImproperlyConfigured("%s sets async_delete but has no %s_delete_progress URL"%(self.web_id, self.url_prefix))
+
+    def get_delete_timestamp(self):
+        # some databases don't store microseconds
+        return datetime.datetime.now().replace(microsecond=0)
+
+    def is_delete_pending(self, instance):
+        self.assert_instance_type(instance)
+        if not self.async_delete:
+            return False
+        return getattr(instance, self.get_delete_pending_field()) is not None
+
+    # hide objects that are being deleted
+    def exclude_delete_pending(self, queryset):
+        if not self.async_delete:
+            return queryset
+        field = self.get_delete_pending_field()
+        return queryset.filter(**{ field+"__isnull": True })
+
+    # get objects whose delete has made no progress for too long
+    def get_stale_deletes(self):
+        field = self.get_delete_pending_field()
+        now = self.get_delete_timestamp()
+        stale = now - datetime.timedelta(seconds=self.delete_stale_timeout)
+        return self.model._default_manager.filter(**{ field+"__lt": stale })
+
+    # flag the object as pending deletion. Returns False if another worker
+    # is already deleting it.
+    def mark_delete_pending(self, instance):
+        self.assert_instance_type(instance)
+        field = self.get_delete_pending_field()
+        now = self.get_delete_timestamp()
+        stale = now - datetime.timedelta(seconds=self.delete_stale_timeout)
+
+        queryset = self.model._default_manager.filter(pk=instance.pk)
+        queryset = queryset.filter(Q(**{ field+"__isnull": True }) | Q(**{ field+"__lt": stale }))
+        if queryset.update(**{ field: now }) != 1:
+            return False
+
+        setattr(instance, field, now)
+        return True
+
+    # tell other workers we are still alive. Returns False if another
+    # worker has taken over.
+    def refresh_delete_pending(self, instance):
+        self.assert_instance_type(instance)
+        field = self.get_delete_pending_field()
+        last = getattr(instance, field)
+        now = self.get_delete_timestamp()
+
+        queryset = self.model._default_manager.filter(pk=instance.pk, **{ field: last })
+        if queryset.update(**{ field: now }) != 1:
+            return False
+
+        setattr(instance, field, now)
+        return True
+
+    # clear the flag, unless another worker has taken over
+    def unmark_delete_pending(self, instance):
+        self.assert_instance_type(instance)
+        field = self.get_delete_pending_field()
+        last = getattr(instance, field)
+        self.model._default_manager.filter(pk=instance.pk, **{ field: last }).update(**{ field: None })
+        setattr(instance, field, None)
+
+    # delete children in bounded batches, then the object itself
+    def delete_cascade(self, instance):
+        self.assert_instance_type(instance)
+        batch_size = self.delete_batch_size
+
+        for queryset in self.get_delete_cascade(instance):
+            while True:
+                pks = list(queryset.values_list('pk', flat=True)[:batch_size])
+                if len(pks) == 0:
+                    break
+                queryset.filter(pk__in=pks).delete()
+                if not self.refresh_delete_pending(instance):
+                    return
+
+        if self.refresh_delete_pending(instance):
+            instance.delete()
+
+    # delete an object this worker has claimed
+    def run_delete(self, instance):
+        self.assert_instance_type(instance)
+        try:
+            self.delete_cascade(instance)
+        except Exception:
+            logger.exception("Deleting %s %s failed"%(self.web_id, instance.pk))
+            # unlock the object, so it can be deleted again
+            self.unmark_delete_pending(instance)
+
+    # get breadcrumbs to show while a background delete is running
+    def get_delete_progress_breadcrumbs(self, instance):
+        self.assert_instance_type(instance)
+        breadcrumbs = self.get_view_breadcrumbs(instance)
+        breadcrumbs.append(breadcrumb(self.get_delete_progress_url(instance), "delete"))
+        return breadcrumbs
+
+    def delete_pending_response(self, instance, next=None):
+        url = self.get_delete_progress_url(instance)
+        if next is not None:
+            url = "%s?next=%s"%(url, urlquote(next))
+        return HttpResponseRedirect(url)
+
     # get breadcrumbs to show while deleting this object
     def get_delete_breadcrumbs(self, instance):
         self.assert_instance_type(instance)
@@ -293,11 +569,27 @@ class web(object):
         else:
             return None
 
+    def check_instance_perms(self, request, breadcrumbs, instance):
+        error_list = []
+        if not self.has_instance_perms(request.user, instance):
+            error_list.append("You cannot access this %s object"%(self.verbose_name))
+
+        if len(error_list) > 0:
+            return self.permission_denied_response(request, breadcrumbs, error_list)
+        else:
+            return None
+
     #####################
     # GENERIC FUNCTIONS #
     #####################
 
-    def object_list(self, request, form, table, template=None, kwargs={}, context={}):
+    # Either pass a table built by the caller, or a queryset and the
+    # table_class to build the table from. Only a queryset can be filtered
+    # with filter_queryset_for_user, or have objects pending deletion
+    # hidden. A web that overrides filter_queryset_for_user must pass the
+    # queryset; a prebuilt table still shows objects pending deletion.
+    @record_metrics("list")
+    def object_list(self, request, form, table=None, template=None, kwargs={}, context={}, queryset=None, table_class=None):
         breadcrumbs = self.get_list_breadcrumbs(**kwargs)
 
         error = self.check_list_perms(request, breadcrumbs)
@@ -307,6 +599,20 @@ class web(object):
         if template is None:
             template='%s/object_list.html'%"django_webs"
 
+        if table is None:
+            # hide rows the user may not see before they are counted
+            queryset = self.get_list_queryset(request.user, queryset)
+            table = table_class(queryset)
+            order_by = request.GET.get(table.prefixed_order_by_field)
+            if order_by is not None:
+                table.order_by = order_by
+        else:
+            # a table built by the caller can't be filtered, refuse to
+            # show it if it needs to be
+            probe = self.model._default_manager.all()
+            if self.filter_queryset_for_user(request.user, probe) is not probe:
+                raise ImproperlyConfigured("%s filters rows, object_list needs the queryset"%(self.web_id))
+
         paginator = Paginator(table.rows, 50) # Show 50 objects per page
 
         # Make sure page request is an int. If not, deliver first page.
@@ -336,6 +642,7 @@ class web(object):
         return render_to_response(template, defaults,
                 context_instance=RequestContext(request))
 
+    @record_metrics("view")
     def object_view(self, request, instance, template=None):
         self.assert_instance_type(instance)
         breadcrumbs = self.get_view_breadcrumbs(instance)
@@ -344,6 +651,13 @@ class web(object):
         if error is not None:
             return error
 
+        error = self.check_instance_perms(request, breadcrumbs, instance)
+        if error is not None:
+            return error
+
+        if self.is_delete_pending(instance):
+            return self.delete_pending_response(instance, request.GET.get("next"))
+
         if template is None:
             template='%s/%s_detail.html'%(self.app_label,self.template_prefix)
         return render_to_response(template, {
@@ -352,6 +666,7 @@ class web(object):
                 'breadcrumbs': breadcrumbs,
                 },context_instance=RequestContext(request))
 
+    @record_metrics("add")
     def object_add(self, request, template=None, kwargs={}):
         breadcrumbs = self.get_add_breadcrumbs(**kwargs)
 
@@ -387,6 +702,7 @@ class web(object):
                 'media' : form.media,
                 },context_instance=RequestContext(request))
 
+    @record_metrics("edit")
     def object_edit(self, request, instance, template=None):
         self.assert_instance_type(instance)
         breadcrumbs = self.get_edit_breadcrumbs(instance)
@@ -398,6 +714,13 @@ class web(object):
         if error is not None:
             return error
 
+        error = self.check_instance_perms(request, breadcrumbs, instance)
+        if error is not None:
+            return error
+
+        if self.is_delete_pending(instance):
+            return self.delete_pending_response(instance, request.GET.get("next"))
+
         if request.method == 'POST':
             form = self.form(request.POST, request.FILES, instance=instance)
             if form.is_valid():
@@ -421,8 +744,12 @@ class web(object):
                 'media' : form.media,
                 },context_instance=RequestContext(request))
 
+    @record_metrics("delete")
     def object_delete(self, request, instance, template=None):
         self.assert_instance_type(instance)
+        if self.async_delete:
+            self.check_async_delete()
+
         breadcrumbs = self.get_delete_breadcrumbs(instance)
 
         if template is None:
@@ -432,10 +759,25 @@ class web(object):
         if error is not None:
             return error
 
+        error = self.check_instance_perms(request, breadcrumbs, instance)
+        if error is not None:
+            return error
+
+        if self.is_delete_pending(instance):
+            return self.delete_pending_response(instance, request.GET.get("next"))
+
         errorlist = []
         if request.method == 'POST':
             errorlist = instance.check_delete()
             if len(errorlist) == 0:
+                if self.async_delete:
+                    url = self.get_delete_finished_url(instance)
+                    url = request.GET.get("next",url)
+                    # if this fails another worker is already deleting it
+                    if self.mark_delete_pending(instance):
+                        queue_delete(self, instance.pk)
+                    return self.delete_pending_response(instance, url)
+
                 url = self.get_delete_finished_url(instance)
                 url = request.GET.get("next",url)
                 instance.delete()
@@ -447,4 +789,43 @@ class web(object):
                 'errorlist': errorlist,
                 },context_instance=RequestContext(request))
 
+    @record_metrics("delete_progress")
+    def object_delete_progress(self, request, object_id, template=None):
+        try:
+            instance = self.model._default_manager.get(pk=object_id)
+        except self.model.DoesNotExist:
+            instance = None
+
+        if instance is None:
+            breadcrumbs = self.get_list_breadcrumbs()
+        else:
+            breadcrumbs = self.get_delete_progress_breadcrumbs(instance)
+
+        if template is None:
+            template='%s/object_delete_progress.html'%"django_webs"
+
+        error = self.check_view_perms(request, breadcrumbs)
+        if error is not None:
+            return error
+
+        # the object is gone, so the delete has finished
+        if instance is None:
+            url = self.get_list_url()
+            url = request.GET.get("next",url)
+            return HttpResponseRedirect(url)
+
+        error = self.check_instance_perms(request, breadcrumbs, instance)
+        if error is not None:
+            return error
+
+        # if the worker deleting it has died, resume the delete
+        pending = self.is_delete_pending(instance)
+        if pending and self.mark_delete_pending(instance):
+            queue_delete(self, instance.pk)
 
+        return render_to_response(template, {
+                'object': instance,
+                'pending': pending,
+                'web': self,
+                'breadcrumbs': breadcrumbs,
+                },context_instance=RequestContext(request))
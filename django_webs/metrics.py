@@ -0,0 +1,314 @@
+# django-webs - high level web layer for django
+# Copyright (C) 2008-2011 Brian May
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Per web_id and action request metrics, shared between all worker
+# processes on a host through a memory mapped file. Set WEBS_METRICS_FILE
+# in settings to enable. Responses changed by later middleware, such as
+# the 304s from ConditionalGetMiddleware, are only seen if
+# django_webs.metrics.metrics_middleware is listed before it in
+# MIDDLEWARE_CLASSES.
+
+from django.conf import settings
+from django.db import connections
+from django.http import HttpResponse
+
+import fcntl
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+
+logger = logging.getLogger(__name__)
+
+# flock() locks belong to the open file, not the thread, so threads in
+# one process also need to exclude each other
+_lock = threading.Lock()
+
+# upper bounds of the latency histogram buckets, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# number of web_id/action pairs that can be recorded
+NUM_SLOTS = 512
+
+MAGIC = "WEBSMET1"
+HEADER = struct.Struct("<8sI")
+# key, requests, latency sum, queries, 403 responses, 304 responses, buckets
+SLOT = struct.Struct("<64sQdQQQ%dQ" % len(BUCKETS))
+FILE_SIZE = HEADER.size + NUM_SLOTS * SLOT.size
+
+class metrics_file(object):
+    def __init__(self, filename):
+        self.pid = os.getpid()
+        self.map = None
+        self.fd = os.open(filename, os.O_RDWR | os.O_CREAT, 0644)
+        try:
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+            try:
+                if os.fstat(self.fd).st_size < FILE_SIZE:
+                    os.ftruncate(self.fd, FILE_SIZE)
+                self.map = mmap.mmap(self.fd, FILE_SIZE)
+                magic, num_slots = HEADER.unpack_from(self.map, 0)
+                if magic != MAGIC or num_slots != NUM_SLOTS:
+                    self.map[:] = "\0" * FILE_SIZE
+                    HEADER.pack_into(self.map, 0, MAGIC, NUM_SLOTS)
+            finally:
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+        except:
+            self.close()
+            raise
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def find_slot(self, key):
+        # open addressing, so every process agrees where a key lives
+        start = zlib.crc32(key) % NUM_SLOTS
+        for i in range(NUM_SLOTS):
+            offset = HEADER.size + ((start + i) % NUM_SLOTS) * SLOT.size
+            slot_key = self.map[offset:offset+64].rstrip("\0")
+            if slot_key == key or slot_key == "":
+                return offset
+        return None
+
+    def update(self, key, latency, queries, status):
+        offset = self.find_slot(key)
+        if offset is None:
+            return
+        values = list(SLOT.unpack_from(self.map, offset))
+        values[0] = key
+        values[1] += 1
+        values[2] += latency
+        values[3] += queries
+        if status == 403:
+            values[4] += 1
+        elif status == 304:
+            values[5] += 1
+        for i, bound in enumerate(BUCKETS):
+            if latency <= bound:
+                values[6+i] += 1
+                break
+        SLOT.pack_into(self.map, offset, *values)
+
+    def record(self, key, latency, queries, status):
+        if isinstance(key, unicode):
+            key = key.encode("utf-8")
+        key = key[:64]
+        _lock.acquire()
+        try:
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+            try:
+                self.update(key, latency, queries, status)
+            finally:
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+        finally:
+            _lock.release()
+
+    def read(self):
+        result = []
+        _lock.acquire()
+        try:
+            fcntl.flock(self.fd, fcntl.LOCK_SH)
+            try:
+                for i in range(NUM_SLOTS):
+                    offset = HEADER.size + i * SLOT.size
+                    values = SLOT.unpack_from(self.map, offset)
+                    key = values[0].rstrip("\0")
+                    if key != "":
+                        result.append((key,) + values[1:])
+            finally:
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+        finally:
+            _lock.release()
+        return result
+
+_metrics = None
+_metrics_failed_pid = None
+_metrics_lock = threading.Lock()
+
+def get_metrics_file():
+    global _metrics, _metrics_failed_pid
+    filename = getattr(settings, 'WEBS_METRICS_FILE', None)
+    if filename is None:
+        return None
+
+    _metrics_lock.acquire()
+    try:
+        pid = os.getpid()
+        # don't retry, or the log fills with the same error
+        if _metrics_failed_pid == pid:
+            return None
+        # flock() locks are shared across fork(), so each worker needs its
+        # own open file
+        if _metrics is None or _metrics.pid != pid:
+            if _metrics is not None:
+                _metrics.close()
+                _metrics = None
+            try:
+                _metrics = metrics_file(filename)
+            except Exception:
+                logger.exception("Cannot open metrics file %s"%(filename))
+                _metrics_failed_pid = pid
+                return None
+        return _metrics
+    finally:
+        _metrics_lock.release()
+
+MIDDLEWARE = "django_webs.metrics.metrics_middleware"
+
+# metrics must never break the request
+def record(metrics, key, latency, queries, status):
+    try:
+        metrics.record(key, latency, queries, status)
+    except Exception:
+        logger.exception("Cannot record metrics for %s"%(key))
+
+class counting_cursor(object):
+    def __init__(self, cursor, counter):
+        self.cursor = cursor
+        self.counter = counter
+
+    def execute(self, *args, **kwargs):
+        self.counter[0] += 1
+        return self.cursor.execute(*args, **kwargs)
+
+    def executemany(self, *args, **kwargs):
+        self.counter[0] += 1
+        return self.cursor.executemany(*args, **kwargs)
+
+    def __getattr__(self, attr):
+        return getattr(self.cursor, attr)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+# count queries on every connection, without keeping the SQL like the
+# debug cursor does. Connections are thread local, so this only sees
+# this thread's queries.
+def start_counting_queries(counter):
+    saved = []
+    for conn in connections.all():
+        old_cursor = conn.__dict__.get('cursor')
+        def cursor(make_cursor=conn.cursor):
+            return counting_cursor(make_cursor(), counter)
+        conn.cursor = cursor
+        saved.append((conn, old_cursor))
+    return saved
+
+def stop_counting_queries(saved):
+    for conn, old_cursor in saved:
+        if old_cursor is None:
+            del conn.cursor
+        else:
+            conn.cursor = old_cursor
+
+def record_metrics(action):
+    def decorator(func):
+        def wrapper(self, request, *args, **kwargs):
+            metrics = get_metrics_file()
+            if metrics is None:
+                return func(self, request, *args, **kwargs)
+
+            key = "%s:%s"%(self.web_id, action)
+            counter = [ 0 ]
+            saved = start_counting_queries(counter)
+            start = time.time()
+            try:
+                try:
+                    response = func(self, request, *args, **kwargs)
+                finally:
+                    latency = time.time() - start
+                    stop_counting_queries(saved)
+            except:
+                record(metrics, key, latency, counter[0], 500)
+                raise
+
+            # let the middleware record the final status
+            if MIDDLEWARE in settings.MIDDLEWARE_CLASSES:
+                request.webs_metrics = (metrics, key, latency, counter[0])
+            else:
+                record(metrics, key, latency, counter[0], response.status_code)
+            return response
+        wrapper.__name__ = func.__name__
+        wrapper.__doc__ = func.__doc__
+        return wrapper
+    return decorator
+
+class metrics_middleware(object):
+    def process_response(self, request, response):
+        sample = getattr(request, "webs_metrics", None)
+        if sample is not None:
+            del request.webs_metrics
+            metrics, key, latency, queries = sample
+            record(metrics, key, latency, queries, response.status_code)
+        return response
+
+def escape_label(value):
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def metrics_view(request):
+    metrics = get_metrics_file()
+    rows = []
+    if metrics is not None:
+        try:
+            rows = metrics.read()
+        except Exception:
+            logger.exception("Cannot read metrics file")
+
+    duration = []
+    queries = []
+    forbidden = []
+    not_modified = []
+    for row in rows:
+        # the key may have been cut off in the middle of a character
+        web_id, action = row[0].decode("utf-8", "ignore").rsplit(":", 1)
+        labels = 'web_id="%s",action="%s"'%(escape_label(web_id), escape_label(action))
+        count, latency, num_queries, num_forbidden, num_not_modified = row[1:6]
+
+        total = 0
+        for bound, value in zip(BUCKETS, row[6:]):
+            total += value
+            duration.append('webs_request_duration_seconds_bucket{%s,le="%s"} %d'%(labels, bound, total))
+        duration.append('webs_request_duration_seconds_bucket{%s,le="+Inf"} %d'%(labels, count))
+        duration.append('webs_request_duration_seconds_sum{%s} %r'%(labels, latency))
+        duration.append('webs_request_duration_seconds_count{%s} %d'%(labels, count))
+        queries.append('webs_request_queries_total{%s} %d'%(labels, num_queries))
+        forbidden.append('webs_request_forbidden_total{%s} %d'%(labels, num_forbidden))
+        not_modified.append('webs_request_not_modified_total{%s} %d'%(labels, num_not_modified))
+
+    lines = []
+    lines.append("# HELP webs_request_duration_seconds Time taken by generic views.")
+    lines.append("# TYPE webs_request_duration_seconds histogram")
+    lines.extend(duration)
+    lines.append("# HELP webs_request_queries_total Database queries made by generic views.")
+    lines.append("# TYPE webs_request_queries_total counter")
+    lines.extend(queries)
+    lines.append("# HELP webs_request_forbidden_total Generic view responses with status 403.")
+    lines.append("# TYPE webs_request_forbidden_total counter")
+    lines.extend(forbidden)
+    lines.append("# HELP webs_request_not_modified_total Generic view responses with status 304.")
+    lines.append("# TYPE webs_request_not_modified_total counter")
+    lines.extend(not_modified)
+
+    return HttpResponse("\n".join(lines) + "\n",
+            content_type="text/plain; version=0.0.4")
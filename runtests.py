@@ -0,0 +1,35 @@
+#!/usr/bin/env python
+# django-webs - high level web layer for django
+# Copyright (C) 2008-2011 Brian May
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+
+root_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(root_dir, "tests"))
+sys.path.insert(0, root_dir)
+os.environ["DJANGO_SETTINGS_MODULE"] = "settings"
+
+from django.conf import settings
+from django.test.utils import get_runner
+
+def main():
+    test_runner = get_runner(settings)(verbosity=1, interactive=False)
+    failures = test_runner.run_tests(sys.argv[1:] or [ "testapp" ])
+    sys.exit(bool(failures))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,14 @@
+from django.db import models
+
+class parent(models.Model):
+    name = models.CharField(max_length=100)
+    delete_pending = models.DateTimeField(null=True, blank=True)
+
+    def __unicode__(self):
+        return self.name
+
+    def check_delete(self):
+        return []
+
+class child(models.Model):
+    parent = models.ForeignKey(parent)
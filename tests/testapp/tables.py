@@ -0,0 +1,4 @@
+import django_tables2 as tables
+
+class parent_table(tables.Table):
+    name = tables.Column()
@@ -0,0 +1,229 @@
+import datetime
+import os
+import tempfile
+
+from django.conf import settings
+from django.contrib.auth.models import User, AnonymousUser
+from django.core.exceptions import ImproperlyConfigured
+from django.core.urlresolvers import reverse
+from django.http import HttpResponseNotModified
+from django.test import TestCase
+from django.test.client import RequestFactory
+
+import django_webs
+from django_webs import metrics
+from testapp import models
+from testapp.webs import parent_web, visible_parent_web
+
+class async_delete_test(TestCase):
+    def setUp(self):
+        self.web = parent_web()
+        self.parent = models.parent.objects.create(name="parent")
+        for i in range(5):
+            models.child.objects.create(parent=self.parent)
+
+        User.objects.create_superuser("admin", "admin@example.com", "admin")
+        self.client.login(username="admin", password="admin")
+
+    def get_parent(self):
+        return models.parent.objects.get(pk=self.parent.pk)
+
+    def make_stale(self, instance):
+        stale = self.web.get_delete_timestamp() - datetime.timedelta(seconds=self.web.delete_stale_timeout+1)
+        models.parent.objects.filter(pk=instance.pk).update(delete_pending=stale)
+        instance.delete_pending = stale
+
+    def test_claim(self):
+        self.assertTrue(self.web.mark_delete_pending(self.parent))
+        self.assertFalse(self.web.mark_delete_pending(self.get_parent()))
+        self.assertTrue(self.web.is_delete_pending(self.get_parent()))
+
+    def test_takeover(self):
+        self.assertTrue(self.web.mark_delete_pending(self.parent))
+        self.make_stale(self.parent)
+
+        other = self.get_parent()
+        self.assertTrue(self.web.mark_delete_pending(other))
+
+        # the old worker deletes one batch, then notices and stops
+        self.web.delete_cascade(self.parent)
+        self.assertEqual(models.child.objects.count(), 3)
+        self.assertTrue(models.parent.objects.filter(pk=self.parent.pk).exists())
+
+        # and must not unlock the object for the new worker
+        self.web.unmark_delete_pending(self.parent)
+        self.assertEqual(self.get_parent().delete_pending, other.delete_pending)
+
+        self.web.delete_cascade(other)
+        self.assertEqual(models.child.objects.count(), 0)
+        self.assertFalse(models.parent.objects.filter(pk=self.parent.pk).exists())
+
+    def test_sweep(self):
+        self.assertTrue(self.web.mark_delete_pending(self.parent))
+        django_webs.sweep_deletes()
+        self.assertTrue(models.parent.objects.filter(pk=self.parent.pk).exists())
+
+        self.make_stale(self.parent)
+        django_webs.sweep_deletes()
+        self.assertFalse(models.parent.objects.filter(pk=self.parent.pk).exists())
+        self.assertEqual(models.child.objects.count(), 0)
+
+    def test_delete_view(self):
+        url = reverse("parent_delete", args=[ self.parent.pk ])
+        response = self.client.post(url)
+        progress_url = reverse("parent_delete_progress", args=[ self.parent.pk ])
+        list_url = reverse("parent_list")
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(response["Location"].endswith("%s?next=%s"%(progress_url, list_url)))
+
+        # with no workers the delete runs when the request finishes
+        self.assertFalse(models.parent.objects.filter(pk=self.parent.pk).exists())
+        response = self.client.get(progress_url, { 'next': "/done/" })
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(response["Location"].endswith("/done/"))
+
+    def test_pending_is_locked(self):
+        self.assertTrue(self.web.mark_delete_pending(self.parent))
+        progress_url = reverse("parent_delete_progress", args=[ self.parent.pk ])
+
+        for name in [ "parent_detail", "parent_edit", "parent_delete" ]:
+            response = self.client.get(reverse(name, args=[ self.parent.pk ]))
+            self.assertEqual(response.status_code, 302)
+            self.assertTrue(response["Location"].endswith(progress_url))
+
+        response = self.client.get(progress_url)
+        self.assertContains(response, "is being deleted")
+
+    def test_pending_needs_perms(self):
+        self.assertTrue(self.web.mark_delete_pending(self.parent))
+        self.client.logout()
+        response = self.client.get(reverse("parent_delete", args=[ self.parent.pk ]))
+        self.assertEqual(response.status_code, 403)
+
+    def test_progress_not_pending(self):
+        response = self.client.get(reverse("parent_delete_progress", args=[ self.parent.pk ]))
+        self.assertContains(response, "is not being deleted")
+
+class metrics_test(TestCase):
+    def setUp(self):
+        self.web = parent_web()
+        self.parent = models.parent.objects.create(name="parent")
+        self.factory = RequestFactory()
+
+        self.filename = tempfile.mktemp()
+        settings.WEBS_METRICS_FILE = self.filename
+        metrics._metrics = None
+        metrics._metrics_failed_pid = None
+        self.old_middleware = settings.MIDDLEWARE_CLASSES
+
+    def tearDown(self):
+        settings.MIDDLEWARE_CLASSES = self.old_middleware
+        del settings.WEBS_METRICS_FILE
+        if metrics._metrics is not None:
+            metrics._metrics.close()
+            metrics._metrics = None
+        os.unlink(self.filename)
+
+    def get_request(self):
+        request = self.factory.get("/")
+        request.user = AnonymousUser()
+        return request
+
+    def get_metrics(self):
+        return metrics.metrics_view(self.factory.get("/")).content
+
+    def test_view(self):
+        response = self.web.object_view(self.get_request(), self.parent)
+        self.assertEqual(response.status_code, 200)
+
+        content = self.get_metrics()
+        self.assertTrue('webs_request_duration_seconds_bucket{web_id="parent",action="view",le="+Inf"} 1\n' in content)
+        self.assertTrue('webs_request_duration_seconds_count{web_id="parent",action="view"} 1\n' in content)
+        self.assertTrue('webs_request_forbidden_total{web_id="parent",action="view"} 0\n' in content)
+        # the object isn't filtered, so viewing it needs no queries
+        self.assertTrue('webs_request_queries_total{web_id="parent",action="view"} 0\n' in content)
+
+    def test_queries_and_forbidden(self):
+        response = self.web.object_delete_progress(self.get_request(), self.parent.pk)
+        self.assertEqual(response.status_code, 200)
+        response = self.web.object_delete(self.get_request(), self.parent)
+        self.assertEqual(response.status_code, 403)
+
+        content = self.get_metrics()
+        self.assertTrue('webs_request_queries_total{web_id="parent",action="delete_progress"} 1\n' in content)
+        self.assertTrue('webs_request_forbidden_total{web_id="parent",action="delete"} 1\n' in content)
+        self.assertTrue('action="view"' not in content)
+
+    def test_exception(self):
+        child = models.child.objects.create(parent=self.parent)
+        self.assertRaises(RuntimeError, self.web.object_view, self.get_request(), child)
+        content = self.get_metrics()
+        self.assertTrue('webs_request_duration_seconds_count{web_id="parent",action="view"} 1\n' in content)
+
+    def test_middleware(self):
+        settings.MIDDLEWARE_CLASSES = self.old_middleware + (metrics.MIDDLEWARE,)
+        request = self.get_request()
+        self.web.object_view(request, self.parent)
+        self.assertTrue('action="view"' not in self.get_metrics())
+
+        metrics.metrics_middleware().process_response(request, HttpResponseNotModified())
+        content = self.get_metrics()
+        self.assertTrue('webs_request_not_modified_total{web_id="parent",action="view"} 1\n' in content)
+
+    def test_bad_file(self):
+        settings.WEBS_METRICS_FILE = os.path.join(self.filename, "missing")
+        open(self.filename, "w").close()
+        response = self.web.object_view(self.get_request(), self.parent)
+        self.assertEqual(response.status_code, 200)
+
+class row_filter_test(TestCase):
+    def setUp(self):
+        for i in range(60):
+            models.parent.objects.create(name="visible %d"%i)
+        for i in range(10):
+            models.parent.objects.create(name="hidden %d"%i)
+
+        User.objects.create_superuser("admin", "admin@example.com", "admin")
+        self.client.login(username="admin", password="admin")
+
+    def test_list(self):
+        response = self.client.get(reverse("visible_parent_list"))
+        self.assertEqual(response.status_code, 200)
+        page_obj = response.context['page_obj']
+        self.assertEqual(page_obj.paginator.count, 60)
+        self.assertEqual(page_obj.paginator.num_pages, 2)
+        self.assertNotContains(response, "hidden")
+
+        response = self.client.get(reverse("visible_parent_list"), { 'page': 2 })
+        self.assertEqual(len(response.context['page_obj'].object_list), 10)
+
+    def test_list_hides_pending(self):
+        web = parent_web()
+        instance = models.parent.objects.get(name="hidden 0")
+        self.assertTrue(web.mark_delete_pending(instance))
+
+        response = self.client.get(reverse("parent_list"))
+        self.assertEqual(response.context['page_obj'].paginator.count, 69)
+
+    def test_prebuilt_table(self):
+        self.assertRaises(ImproperlyConfigured, self.client.get, reverse("visible_parent_table"))
+
+    def test_instance_perms(self):
+        web = visible_parent_web()
+        user = User.objects.get(username="admin")
+        visible = models.parent.objects.get(name="visible 0")
+        hidden = models.parent.objects.get(name="hidden 0")
+
+        self.assertNumQueries(1, web.has_instance_perms, user, visible)
+        self.assertTrue(web.has_instance_perms(user, visible))
+        self.assertFalse(web.has_instance_perms(user, hidden))
+        self.assertNumQueries(0, parent_web().has_instance_perms, user, hidden)
+
+    def test_view_hidden(self):
+        web = visible_parent_web()
+        request = RequestFactory().get("/")
+        request.user = User.objects.get(username="admin")
+        hidden = models.parent.objects.get(name="hidden 0")
+        self.assertEqual(web.object_view(request, hidden).status_code, 403)
+        visible = models.parent.objects.get(name="visible 0")
+        self.assertEqual(web.object_view(request, visible).status_code, 200)
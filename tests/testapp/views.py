@@ -0,0 +1,36 @@
+from django.shortcuts import get_object_or_404
+
+from testapp import models
+from testapp.tables import parent_table
+from testapp.webs import parent_web, visible_parent_web
+
+def parent_list(request):
+    return parent_web().object_list(request, None,
+            queryset=models.parent.objects.all(), table_class=parent_table)
+
+def visible_parent_list(request):
+    return visible_parent_web().object_list(request, None,
+            queryset=models.parent.objects.all(), table_class=parent_table)
+
+# a prebuilt table can't be filtered
+def visible_parent_table(request):
+    table = parent_table(models.parent.objects.all())
+    return visible_parent_web().object_list(request, None, table)
+
+def parent_add(request):
+    return parent_web().object_add(request)
+
+def parent_detail(request, object_id):
+    instance = get_object_or_404(models.parent, pk=object_id)
+    return parent_web().object_view(request, instance)
+
+def parent_edit(request, object_id):
+    instance = get_object_or_404(models.parent, pk=object_id)
+    return parent_web().object_edit(request, instance)
+
+def parent_delete(request, object_id):
+    instance = get_object_or_404(models.parent, pk=object_id)
+    return parent_web().object_delete(request, instance)
+
+def parent_delete_progress(request, object_id):
+    return parent_web().object_delete_progress(request, object_id)
@@ -0,0 +1,27 @@
+from django import forms
+from django_webs import web
+
+from testapp import models
+
+class parent_form(forms.ModelForm):
+    class Meta:
+        model = models.parent
+        fields = ('name',)
+
+class parent_web(web):
+    web_id = "parent"
+    app_label = "testapp"
+    model = models.parent
+    form = parent_form
+
+    async_delete = True
+    delete_pending_field = "delete_pending"
+    delete_batch_size = 2
+
+    def get_delete_cascade(self, instance):
+        return [ instance.child_set.all() ]
+
+# only shows parents whose name starts with "visible"
+class visible_parent_web(parent_web):
+    def filter_queryset_for_user(self, user, queryset):
+        return queryset.filter(name__startswith="visible")
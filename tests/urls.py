@@ -0,0 +1,13 @@
+from django.conf.urls.defaults import *
+
+urlpatterns = patterns('testapp.views',
+    url(r'^$', 'parent_list', name='root'),
+    url(r'^parent/$', 'parent_list', name='parent_list'),
+    url(r'^parent/add/$', 'parent_add', name='parent_add'),
+    url(r'^parent/(?P<object_id>\d+)/$', 'parent_detail', name='parent_detail'),
+    url(r'^parent/(?P<object_id>\d+)/edit/$', 'parent_edit', name='parent_edit'),
+    url(r'^parent/(?P<object_id>\d+)/delete/$', 'parent_delete', name='parent_delete'),
+    url(r'^parent/(?P<object_id>\d+)/delete/progress/$', 'parent_delete_progress', name='parent_delete_progress'),
+    url(r'^visible/$', 'visible_parent_list', name='visible_parent_list'),
+    url(r'^visible/table/$', 'visible_parent_table', name='visible_parent_table'),
+)